@@ -14,18 +14,24 @@
 """Perform assembly based on debruijn graph."""
 
 import argparse
+import mmap
 import os
 import sys
 import networkx as nx
-import matplotlib
+import numpy as np
+from collections import Counter, deque
+from itertools import combinations
+from multiprocessing import Pool
 from operator import itemgetter
 import random
 random.seed(9001)
-from random import randint
-import statistics
-import matplotlib.pyplot as plt
-matplotlib.use("Agg")
-import textwrap
+
+try:
+    from numba import njit
+    from numba.core import types
+    from numba.typed import Dict as NumbaDict
+except ImportError:
+    njit = None
 
 __author__ = "Crystal Renaud"
 __copyright__ = "Universite Paris Diderot"
@@ -70,12 +76,42 @@ def get_arguments():
     return parser.parse_args()
 
 
+def read_fastq_bytes(fastq_file):
+    """Yield every sequence line of a fastq file as bytes.
+    Memory-maps the file and locates every newline with one vectorized
+    scan, then slices the sequence lines out of the mapping directly,
+    with no read() buffer copies or per-line Python objects.
+    """
+    if os.path.getsize(fastq_file) == 0:
+        return
+    with open(fastq_file, "rb") as filling:
+        mapping = mmap.mmap(filling.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            data = np.frombuffer(mapping, dtype=np.uint8)
+            size = len(data)
+            newlines = np.flatnonzero(data == ord("\n"))
+            if size and (not len(newlines) or newlines[-1] != size - 1):
+                # last line has no trailing newline
+                newlines = np.append(newlines, size)
+            # tolerate CRLF files: drop a carriage return before the newline
+            ends = np.where((newlines > 0) & (data[newlines - 1] == ord("\r")),
+                            newlines - 1, newlines)
+            # release the buffer export so the mmap can be closed
+            del data
+            starts = np.empty_like(newlines)
+            if len(newlines):
+                starts[0] = 0
+                starts[1:] = newlines[:-1] + 1
+            # the sequence is the 2nd line of each 4-line record
+            for i in range(1, len(newlines), 4):
+                yield mapping[starts[i]:ends[i]]
+        finally:
+            mapping.close()
+
+
 def read_fastq(fastq_file):
-    with open(fastq_file, 'r') as filling:
-        for file in filling: 
-            yield next(filling).strip() #strip pour enlever 
-            next(filling)
-            next(filling)
+    for seq in read_fastq_bytes(fastq_file):
+        yield seq.decode("ascii")
 
 
 def cut_kmer(read, kmer_size):
@@ -84,21 +120,150 @@ def cut_kmer(read, kmer_size):
             yield read[i : (i + kmer_size)]
 
 
+# 2-bit encoding of the nucleotides, anything else (N, ...) maps to -1
+NUCLEOTIDES = "ACGT"
+NUC_CODES = np.full(256, -1, dtype=np.int8)
+for code, nuc in enumerate(NUCLEOTIDES):
+    NUC_CODES[ord(nuc)] = code
+
+
+# up to this k the 4**k count array fits easily in memory (64 MiB int32)
+KMER_ARRAY_MAX = 12
+
+
+if njit is not None:
+    @njit(cache=True)
+    def count_kmers_array(seq, kmer_size, lut, counts):
+        """Same rolling count as count_kmers_nb, into a flat count array
+        indexed by the packed kmer integer (no hashing at all).
+        """
+        mask = (1 << (2 * kmer_size)) - 1
+        kmer = 0
+        loaded = 0
+        for i in range(len(seq)):
+            code = lut[seq[i]]
+            if code < 0:
+                kmer = 0
+                loaded = 0
+                continue
+            kmer = ((kmer << 2) | code) & mask
+            loaded += 1
+            if loaded >= kmer_size:
+                counts[kmer] += 1
+
+    @njit(cache=True)
+    def count_kmers_nb(seq, kmer_size, lut, counts):
+        """Count the kmers of one read with a rolling 2-bit packed integer.
+          :Parameters:
+              seq: read as a uint8 array
+              kmer_size: k-mer length
+              lut: 256-entry nucleotide -> 2-bit code table
+              counts: typed dict kmer integer -> count, updated in place
+        """
+        mask = (1 << (2 * kmer_size)) - 1
+        kmer = 0
+        loaded = 0
+        for i in range(len(seq)):
+            code = lut[seq[i]]
+            if code < 0:
+                kmer = 0
+                loaded = 0
+                continue
+            kmer = ((kmer << 2) | code) & mask
+            loaded += 1
+            if loaded >= kmer_size:
+                if kmer in counts:
+                    counts[kmer] += 1
+                else:
+                    counts[kmer] = 1
+
+
+def decode_kmer(kmer_int, kmer_size):
+    """Turn a 2-bit packed kmer integer back into its string form."""
+    return "".join(NUCLEOTIDES[(kmer_int >> shift) & 3]
+                   for shift in range(2 * (kmer_size - 1), -1, -2))
+
+
+# below this file size the pool startup costs more than it saves
+PARALLEL_MIN_BYTES = 1 << 25
+
+
+def iter_read_chunks(fastq_file, kmer_size, chunk_size=10000):
+    """Yield (reads, kmer_size) batches for the worker pool."""
+    chunk = []
+    for read in read_fastq_bytes(fastq_file):
+        chunk.append(read)
+        if len(chunk) == chunk_size:
+            yield chunk, kmer_size
+            chunk = []
+    if chunk:
+        yield chunk, kmer_size
+
+
+def count_kmer_chunk(args):
+    """Count the kmers of a chunk of reads, pool worker.
+      Returns a plain dict packed kmer integer -> count.
+    """
+    reads, kmer_size = args
+    if kmer_size <= KMER_ARRAY_MAX:
+        array = np.zeros(4 ** kmer_size, dtype=np.int32)
+        for read in reads:
+            seq = np.frombuffer(read, dtype=np.uint8)
+            count_kmers_array(seq, kmer_size, NUC_CODES, array)
+        return {int(kmer): int(array[kmer]) for kmer in np.flatnonzero(array)}
+    counts = NumbaDict.empty(types.int64, types.int64)
+    for read in reads:
+        seq = np.frombuffer(read, dtype=np.uint8)
+        count_kmers_nb(seq, kmer_size, NUC_CODES, counts)
+    return dict(counts)
+
+
 def build_kmer_dict(fastq_file, kmer_size):
-    dico = {}
-    for i in read_fastq(fastq_file): 
-        for kmer in cut_kmer(i, kmer_size):
-            if kmer in dico: 
-                dico[kmer] = dico[kmer] + 1
-            else: 
-                dico[kmer] = dico.get(kmer, 1)
-    return dico            
+    # kmers longer than 31 nucleotides do not fit in an int64
+    if njit is None or kmer_size > 31:
+        dico = Counter()
+        for i in read_fastq(fastq_file):
+            # Counter.update aggregates in C, one hash lookup per kmer
+            dico.update(cut_kmer(i, kmer_size))
+        return dict(dico)
+    if os.path.getsize(fastq_file) >= PARALLEL_MIN_BYTES:
+        # reads are independent: count chunks in parallel and merge the
+        # partial dicts, which is cheap next to the counting itself
+        counts = {}
+        with Pool() as pool:
+            for partial in pool.imap_unordered(
+                    count_kmer_chunk, iter_read_chunks(fastq_file, kmer_size)):
+                for kmer, count in partial.items():
+                    counts[kmer] = counts.get(kmer, 0) + count
+    elif kmer_size <= KMER_ARRAY_MAX:
+        # small k: index a flat preallocated array with the packed kmer,
+        # contiguous memory and no hash lookup
+        array = np.zeros(4 ** kmer_size, dtype=np.int32)
+        for read in read_fastq_bytes(fastq_file):
+            seq = np.frombuffer(read, dtype=np.uint8)
+            count_kmers_array(seq, kmer_size, NUC_CODES, array)
+        counts = {int(kmer): int(array[kmer])
+                  for kmer in np.flatnonzero(array)}
+    else:
+        counts = NumbaDict.empty(types.int64, types.int64)
+        for read in read_fastq_bytes(fastq_file):
+            seq = np.frombuffer(read, dtype=np.uint8)
+            count_kmers_nb(seq, kmer_size, NUC_CODES, counts)
+    return {decode_kmer(kmer, kmer_size): count
+            for kmer, count in counts.items()}
 
 
 def build_graph(kmer_dict):
     graph = nx.DiGraph()
-    for kmer in kmer_dict:
-        graph.add_edge(kmer[0 : -1], kmer[1: ], weight = kmer_dict[kmer])
+    # every kmer spawns two fresh (k-1)-mer substrings but about half
+    # are shared with neighbouring kmers: keep one object per unique
+    # node so the graph references a single string per (k-1)-mer
+    canon = {}
+    def intern(node):
+        return canon.setdefault(node, node)
+    # bulk insertion, one add_edge call per kmer costs far more
+    graph.add_weighted_edges_from((intern(kmer[0 : -1]), intern(kmer[1: ]), weight)
+                                  for kmer, weight in kmer_dict.items())
     return graph
 
 
@@ -113,8 +278,13 @@ def remove_paths(graph, path_list, delete_entry_node, delete_sink_node):
 
 
 def std(data):
-    std = statistics.stdev(data)
-    return std
+    # statistics.stdev does exact Fraction accumulation, pure overhead
+    # for the handful of weights scored per bubble
+    nb_values = len(data)
+    if nb_values < 2:
+        return 0.0
+    mean = sum(data) / nb_values
+    return (sum((value - mean) ** 2 for value in data) / (nb_values - 1)) ** 0.5
 
 
 def select_best_path(graph, path_list, path_length, weight_avg_list, 
@@ -125,16 +295,43 @@ def select_best_path(graph, path_list, path_length, weight_avg_list,
     elif std(path_length) > 0:
         del path_list[path_length.index(max(path_length))]
     else :
-        del path_list[randint(0, len(path_list))]
+        # randint is inclusive on both ends and could return len(path_list)
+        del path_list[random.randrange(len(path_list))]
     
     graph = remove_paths(graph, path_list, delete_entry_node, delete_sink_node)
     return graph
 
 
 def path_average_weight(graph, path):
-    mean_weight = statistics.mean([d["weight"] for (u, v, d) in graph.subgraph(path).edges(data=True)])
+    # direct lookup of the consecutive edges, no subgraph view to build
+    mean_weight = sum(graph[u][v]["weight"]
+                      for u, v in zip(path, path[1:])) / (len(path) - 1)
     return mean_weight
 
+def lowest_common_ancestor(graph, node_a, node_b, anc_cache=None):
+    """Lowest common ancestor of two nodes of a DAG (None if they have
+    no common ancestor). Intersects the two ancestor sets and returns a
+    member with no successor inside the intersection, which is much
+    cheaper than nx.lowest_common_ancestor for one-off queries. A node
+    counts as its own ancestor. anc_cache memoizes ancestor sets across
+    calls on an unchanged graph.
+    """
+    if anc_cache is None:
+        anc_cache = {}
+    for node in (node_a, node_b):
+        if node not in anc_cache:
+            anc_cache[node] = nx.ancestors(graph, node) | {node}
+    common = anc_cache[node_a] & anc_cache[node_b]
+    for node in common:
+        if not any(succ in common for succ in graph.successors(node)):
+            return node
+    if common:
+        # every member has a successor inside the set: the graph cycles
+        raise nx.NetworkXError(
+            "lowest_common_ancestor is only defined on directed acyclic graphs")
+    return None
+
+
 def solve_bubble(graph, ancestor_node, descendant_node):
     paths = list(nx.all_simple_paths(graph, ancestor_node, descendant_node))
     weight_avg_list = [path_average_weight(graph, i) for i in paths]
@@ -142,22 +339,37 @@ def solve_bubble(graph, ancestor_node, descendant_node):
     return select_best_path(graph, paths, path_length, weight_avg_list)
 
 def simplify_bubbles(graph):
-    bubble = False 
-    for node in graph:
-        list_preds = list(graph.predecessors(node))
+    # worklist scan: removing a bubble path only shrinks predecessor and
+    # ancestor sets, so no new bubble can appear at an already cleared
+    # node and only the merge node itself needs rechecking after a solve
+    to_check = deque(graph.nodes())
+    # ancestor sets stay valid as long as the graph is unchanged
+    anc_cache = {}
+    while to_check:
+        node = to_check.popleft()
+        if node not in graph:
+            continue
+        # a self-loop (homopolymer run >= k) makes the node its own
+        # predecessor but never a bubble branch
+        list_preds = [pred for pred in graph.predecessors(node)
+                      if pred != node]
         if len(list_preds) > 1:
-            for i,first_pred in enumerate(list_preds):
-                list_second_preds = list_preds[:i]+list_preds[i+1:]
-                for second_pred in list_second_preds:
-                    ancestor_node = nx.lowest_common_ancestor(graph, first_pred, second_pred)
-                    if ancestor_node:
-                        bubble = True
-                        break
-        if bubble == True:
-            break
-    if bubble:
-        graph = simplify_bubbles(solve_bubble(graph,ancestor_node, node))
-
+            # each unordered pair once, without the O(p) list copies
+            for first_pred, second_pred in combinations(list_preds, 2):
+                ancestor_node = lowest_common_ancestor(graph, first_pred,
+                                                       second_pred, anc_cache)
+                if ancestor_node is not None:
+                    nb_nodes = graph.number_of_nodes()
+                    nb_edges = graph.number_of_edges()
+                    graph = solve_bubble(graph, ancestor_node, node)
+                    if (graph.number_of_nodes() < nb_nodes
+                            or graph.number_of_edges() < nb_edges):
+                        anc_cache = {}
+                        to_check.appendleft(node)
+                    # otherwise the losing path was a bare ancestor->merge
+                    # edge that remove_paths cannot delete: drop the node
+                    # instead of re-detecting the same bubble forever
+                    break
     return graph
 
 def solve_entry_tips(graph, starting_nodes):
@@ -183,24 +395,54 @@ def get_sink_nodes(graph):
 
 def get_contigs(graph, starting_nodes, ending_nodes):
     contigs_list  = []
+    # relabel to integer ids: hashing an int is one operation where the
+    # (k-1)-mer strings are re-hashed on every traversal step
+    mapping = {node: i for i, node in enumerate(graph.nodes())}
+    rev = {i: node for node, i in mapping.items()}
+    int_graph = nx.relabel_nodes(graph, mapping)
+    ending_set = {mapping[node] for node in ending_nodes}
     for start in starting_nodes :
-        for end in ending_nodes: 
-            for path in nx.all_simple_paths(graph, start, end):
-                cont = path[0]
-                for node in path[1:]:
-                    cont = cont + node [-1]
-                contig_size = len(cont)
-                contigs_list.append((cont, contig_size))
-    
+        # one iterative DFS per start; the current path is mutated in
+        # place and a visited set answers membership in O(1), so walking
+        # a linear contig of n nodes is O(n) instead of copying and
+        # scanning the path at every step
+        path = [mapping[start]]
+        visited = {mapping[start]}
+        stack = [int_graph.successors(mapping[start])]
+        if mapping[start] in ending_set:
+            contigs_list.append((start, len(start)))
+        while stack:
+            succ = next(stack[-1], None)
+            if succ is None:
+                stack.pop()
+                visited.discard(path.pop())
+            elif succ not in visited:
+                path.append(succ)
+                visited.add(succ)
+                stack.append(int_graph.successors(succ))
+                if succ in ending_set:
+                    # join once: repeated cont + char is quadratic in the
+                    # contig length
+                    parts = [rev[path[0]]]
+                    parts.extend(rev[step][-1] for step in path[1:])
+                    cont = "".join(parts)
+                    contig_size = len(cont)
+                    contigs_list.append((cont, contig_size))
+
     return contigs_list
                 
 
 
 def save_contigs(contigs_list, output_file):
-    with open(output_file, "w") as file:
-        for i in range(len(contigs_list)):
-            file.write(">contig_" + str(i) + " len=" + str(contigs_list[i][1]) +
-             "\n" + textwrap.fill((contigs_list[i][0]), width=80) + "\n")
+    with open(output_file, "w", buffering=1 << 20) as file:
+        write = file.write
+        for i, (contig, contig_size) in enumerate(contigs_list):
+            write(">contig_" + str(i) + " len=" + str(contig_size) + "\n")
+            # plain slicing: textwrap.fill runs a regex wrapper over the
+            # whole contig just to break it every 80 characters
+            for j in range(0, contig_size, 80):
+                write(contig[j:j + 80])
+                write("\n")
        
 
 def fill(text, width=80):
@@ -209,7 +451,12 @@ def fill(text, width=80):
 
 def draw_graph(graph, graphimg_file):
     """Draw the graph
-    """                                    
+    """
+    # import on demand: loading matplotlib costs hundreds of ms and tens
+    # of MB on every run, and most runs never plot
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
     fig, ax = plt.subplots()
     elarge = [(u, v) for (u, v, d) in graph.edges(data=True) if d['weight'] > 3]
     #print(elarge)
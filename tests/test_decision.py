@@ -9,6 +9,7 @@ from debruijn import std
 from debruijn import path_average_weight
 from debruijn import remove_paths
 from debruijn import select_best_path
+from debruijn import lowest_common_ancestor
 from debruijn import solve_bubble
 from debruijn import simplify_bubbles
 from debruijn import solve_entry_tips
@@ -143,6 +144,31 @@ def test_simplify_bubbles():
     assert (2,10) not in graph_1.edges()
     assert (10, 5) not in graph_1.edges()
 
+def test_lowest_common_ancestor_cyclic():
+    graph = nx.DiGraph()
+    graph.add_edges_from([(1, 2), (2, 1), (1, 3), (2, 4)])
+    with pytest.raises(nx.NetworkXError):
+        lowest_common_ancestor(graph, 3, 4)
+
+def test_simplify_bubbles_self_loop():
+    """A homopolymer run >= k gives a node a self-loop (TTAAAAC at k=4):
+    it is not a bubble and simplify_bubbles must terminate."""
+    graph_1 = nx.DiGraph()
+    graph_1.add_weighted_edges_from([("TTA", "TAA", 6), ("TAA", "AAA", 6),
+                                     ("AAA", "AAA", 5), ("AAA", "AAC", 6)])
+    graph_1 = simplify_bubbles(graph_1)
+    assert ("TAA", "AAA") in graph_1.edges()
+    assert ("AAA", "AAC") in graph_1.edges()
+
+def test_simplify_bubbles_direct_edge():
+    """Bubble whose losing path is the bare ancestor->merge edge:
+    remove_paths cannot delete it, simplify_bubbles must still stop."""
+    graph_1 = nx.DiGraph()
+    graph_1.add_weighted_edges_from([(1, 3, 2), (1, 2, 10), (2, 3, 10)])
+    graph_1 = simplify_bubbles(graph_1)
+    assert (1, 2) in graph_1.edges()
+    assert (2, 3) in graph_1.edges()
+
 def test_solve_entry_tips():
     graph_1 = nx.DiGraph()
     graph_1.add_weighted_edges_from([(1, 2, 10), (3, 2, 2), (2, 4, 15), (4, 5, 15)])